@@ -4,28 +4,159 @@ from __future__ import annotations
 from pathlib import Path
 from typing import Dict, List, Tuple, Optional
 
-import json
 import base64
+import functools
 import httpx
 from urllib.parse import urlparse, urlunparse, quote, unquote
 
-from nonebot import on_message, on_command, logger
+from nonebot import on_message, on_command, logger, get_driver
 from nonebot.adapters.onebot.v11 import Message, MessageEvent, MessageSegment
 from nonebot.params import CommandArg
 from nonebot.rule import to_me
 from nonebot.exception import FinishedException  # 仅用于确保不误捕获（现在不会捕到了）
 
-import os, random, sqlite3
-from nonebot import logger
+import os, random, sqlite3, threading, time
+from collections import OrderedDict
 
 # ========== 配置项 ==========
 DB_PATH = "./picmap.db"  # SQLite 数据库路径，用于随机图功能
+RAND_STRICT_UNIFORM = False  # True：只用 OFFSET 抽签（O(n)）；False：先做 id 区间探测（命中 O(log n)），两者都严格均匀
+RAND_PROBE_TRIES = 3  # 区间探测最多尝试次数；都没正好命中有效 id 时退回 OFFSET 抽签
+# 已挂载到本机的 WebDAV 主机：hostname → 本地挂载根目录
+LOCAL_MOUNTS: Dict[str, Path] = {
+    "192.168.1.177": Path("/mnt"),
+}
+# 不在 LOCAL_MOUNTS 中的 WebDAV 主机走 HTTP 下载，凭据与 sync_webdav 相同（.env 或环境变量）
+_config = get_driver().config
+DAV_USER = getattr(_config, "picmap_dav_user", "") or ""
+DAV_PASS = getattr(_config, "picmap_dav_pass", "") or ""
+DAV_AUTH: tuple[str, str] | None = (str(DAV_USER), str(DAV_PASS)) if (DAV_USER or DAV_PASS) else None
+IMG_CACHE_MAX_BYTES = 256 * 1024 * 1024  # 已编码图片缓存的字节上限
+IMG_REVALIDATE_SECONDS = 600  # 缓存命中超过该时长后，用 HEAD 比对 ETag 再决定是否重新下载
+
+
+# ========== HTTP 客户端（全局复用，保持长连接）==========
+_CLIENT: httpx.AsyncClient | None = None
+
+def _get_client() -> httpx.AsyncClient:
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = httpx.AsyncClient(
+            timeout=httpx.Timeout(15.0, connect=5.0),
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=300),
+        )
+    return _CLIENT
+
+@get_driver().on_shutdown
+async def _close_client():
+    global _CLIENT
+    if _CLIENT is not None:
+        await _CLIENT.aclose()
+        _CLIENT = None
+
+
+# ========== SQLite 连接 ==========
+def _connect(path: str, **kwargs) -> sqlite3.Connection:
+    """打开连接并统一设置 PRAGMA：WAL 让同步脚本写入时机器人仍可读取。"""
+    conn = sqlite3.connect(path, **kwargs)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-20000")
+    return conn
+
+# 进程内长连接：避免每条消息都 connect/close；handler 可能并发，访问时持锁
+_CONN = _connect(DB_PATH, check_same_thread=False, timeout=10)
+_CONN_LOCK = threading.Lock()
+
+@get_driver().on_shutdown
+async def _close_db():
+    with _CONN_LOCK:
+        _CONN.close()
+
+
+# ========== 图片缓存 ==========
+class _ImgLRU:
+    """按字节预算淘汰的 LRU：url → base64://...，附带 ETag 与上次校验时间。"""
+
+    def __init__(self, max_bytes: int = IMG_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._size = 0
+        self._data: "OrderedDict[str, List]" = OrderedDict()  # url -> [b64, etag, checked_at]
+
+    def get(self, url: str) -> Optional[str]:
+        entry = self._data.get(url)
+        if entry is None:
+            return None
+        self._data.move_to_end(url)
+        return entry[0]
+
+    def put(self, url: str, b64: str, etag: Optional[str] = None):
+        self.pop(url)
+        if len(b64) > self.max_bytes:
+            return
+        self._data[url] = [b64, etag, time.monotonic()]
+        self._size += len(b64)
+        while self._size > self.max_bytes:
+            _, (old, _, _) = self._data.popitem(last=False)
+            self._size -= len(old)
+
+    def pop(self, url: str):
+        entry = self._data.pop(url, None)
+        if entry is not None:
+            self._size -= len(entry[0])
+
+    def validator(self, url: str) -> Tuple[Optional[str], float]:
+        _, etag, checked_at = self._data[url]
+        return etag, checked_at
+
+    def touch(self, url: str):
+        # HEAD 校验期间条目可能已被其它协程淘汰
+        entry = self._data.get(url)
+        if entry is not None:
+            entry[2] = time.monotonic()
+
+_IMG_CACHE = _ImgLRU()
+
+def _etag_of(r: httpx.Response) -> Optional[str]:
+    return r.headers.get("etag") or r.headers.get("last-modified")
+
+async def _cached_still_valid(url: str, auth: tuple[str, str] | None) -> bool:
+    etag, checked_at = _IMG_CACHE.validator(url)
+    if time.monotonic() - checked_at < IMG_REVALIDATE_SECONDS:
+        return True
+    if etag is None:
+        return False
+    try:
+        r = await _get_client().head(url, auth=auth)
+    except httpx.TransportError as e:
+        # 网络问题时继续用旧缓存，下次再校验
+        logger.warning(f"revalidate {url} failed: {e}")
+        return True
+    if r.status_code >= 500:
+        logger.warning(f"revalidate {url} failed: HTTP {r.status_code}")
+        return True
+    if r.status_code >= 400:
+        # 404/410 等：图片已删除或不可访问，丢弃缓存
+        return False
+    if _etag_of(r) != etag:
+        return False
+    _IMG_CACHE.touch(url)
+    return True
 
 
 # ========== 工具函数 ==========
+_B64_CHUNK = 57 * 1024
+
 def normalize(text: str) -> str:
     return text.strip()
 
+@functools.lru_cache(maxsize=2048)
+def _parse(u: str):
+    return urlparse(u)
+
 async def url_to_base64_file_spec(url: str, auth: tuple[str, str] | None = None) -> str:
     """
     支持:
@@ -34,7 +165,7 @@ async def url_to_base64_file_spec(url: str, auth: tuple[str, str] | None = None)
     - 通过参数 auth=('user','pass') 显式提供鉴权信息
     返回: base64://... 字符串，可直接传给 MessageSegment.image()
     """
-    p = urlparse(url)
+    p = _parse(url)
 
     # 1️⃣ 处理鉴权优先级
     if auth is None and (p.username or p.password):
@@ -54,103 +185,230 @@ async def url_to_base64_file_spec(url: str, auth: tuple[str, str] | None = None)
     # 3️⃣ 重新拼装 URL
     clean_url = urlunparse((p.scheme, netloc, encoded_path, p.params, p.query, p.fragment))
 
-    # 4️⃣ 发起请求
-    timeout = httpx.Timeout(15.0, connect=5.0)
-    async with httpx.AsyncClient(timeout=timeout, follow_redirects=True) as client:
-        try:
-            r = await client.get(clean_url, auth=auth)
+    # 4️⃣ 先查缓存，过期则按 ETag 校验
+    cached = _IMG_CACHE.get(clean_url)
+    if cached is not None:
+        if await _cached_still_valid(clean_url, auth):
+            return cached
+        _IMG_CACHE.pop(clean_url)
+
+    # 5️⃣ 发起请求（复用全局 client），边下载边编码
+    # 分块大小取 3 的倍数，中途不会产生 base64 填充，可直接拼接
+    try:
+        async with _get_client().stream("GET", clean_url, auth=auth) as r:
             r.raise_for_status()
-        except httpx.HTTPStatusError as e:
-            logger.error(f"HTTP {e.response.status_code} for {clean_url}")
-            raise
-        except Exception as e:
-            logger.exception(f"fetch {clean_url} failed: {e}")
-            raise
+            buf = bytearray(b"base64://")
+            async for chunk in r.aiter_bytes(chunk_size=_B64_CHUNK):
+                buf.extend(base64.b64encode(chunk))
+            etag = _etag_of(r)
+    except httpx.HTTPStatusError as e:
+        logger.error(f"HTTP {e.response.status_code} for {clean_url}")
+        raise
+    except Exception as e:
+        logger.exception(f"fetch {clean_url} failed: {e}")
+        raise
+
+    file_spec = buf.decode("ascii")
+    _IMG_CACHE.put(clean_url, file_spec, etag)
+    return file_spec
+
+def _db_signature() -> Tuple[int, int]:
+    # WAL 模式下提交先落到 -wal 文件，主库与 -wal 的 mtime 一起看
+    sig = []
+    for path in (DB_PATH, DB_PATH + "-wal"):
+        try:
+            sig.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            sig.append(0)
+    return tuple(sig)
+
+_DB_SIG = _db_signature()
 
-        b64 = base64.b64encode(r.content).decode("ascii")
-        return f"base64://{b64}"
+# 所有已启用的主名 + 别名；不在集合里的消息直接放行，不碰 SQLite。
+# None 表示尚未加载或加载失败（如旧库没有 person_alias），此时不做预筛，全部交给 SQL 判断
+_NAME_SET: frozenset[str] | None = None
+
+def _reload_names():
+    global _NAME_SET
+    try:
+        with _CONN_LOCK:
+            rows = _CONN.execute("""
+                SELECT name FROM person WHERE enabled=1
+                UNION
+                SELECT a.alias FROM person_alias a
+                JOIN person p ON p.id = a.person_id
+                WHERE p.enabled=1
+            """).fetchall()
+    except sqlite3.Error as e:
+        logger.warning(f"picmap: load names failed, name prefilter disabled: {e}")
+        _NAME_SET = None
+        return
+    _NAME_SET = frozenset(r[0] for r in rows)
+
+@get_driver().on_startup
+async def _load_names():
+    _reload_names()
+
+def _invalidate_if_changed():
+    """sync_webdav 在另一进程写库；库文件变化时清空查询缓存并重载名字集合。"""
+    global _DB_SIG
+    sig = _db_signature()
+    if sig != _DB_SIG:
+        _DB_SIG = sig
+        _lookup_cached.cache_clear()
+        _reload_names()
 
 def lookup_db(name: str) -> Optional[Tuple[str, str]]:
     """
     从数据库查找人物目录。
-    返回 ('webdav', dav_url)，找不到返回 None。
+    返回 ('url', dav_url)，找不到返回 None。
     """
+    _invalidate_if_changed()
     key = normalize(name)
-    conn = sqlite3.connect(DB_PATH, timeout=10)
-    try:
-        cur = conn.cursor()
+    if _NAME_SET is not None and key not in _NAME_SET:
+        return None
+    return _lookup_cached(key)
 
+@functools.lru_cache(maxsize=4096)
+def _lookup_cached(key: str) -> Optional[Tuple[str, str]]:
+    # 未命中（None）同样会被缓存，普通聊天文本不会反复查库
+    with _CONN_LOCK:
         # 1) 先查主名
-        row = cur.execute(
+        row = _CONN.execute(
             "SELECT dav_url FROM person WHERE name=? AND enabled=1",
             (key,)
         ).fetchone()
         if row:
             return ("url", row[0])
 
-        # 2) 再查别名（解析 JSON）
-        rows = cur.execute(
-            "SELECT name, alias_json, dav_url FROM person WHERE enabled=1"
-        ).fetchall()
-        for name_, alias_json, dav_url in rows:
-            try:
-                aliases = json.loads(alias_json or "[]")
-            except Exception:
-                aliases = []
-            if isinstance(aliases, list) and key in aliases:
-                return ("url", dav_url)
-        return None
-    finally:
-        conn.close()
+        # 2) 再查别名
+        pid = _alias_person_id(_CONN, key)
+        if pid is None:
+            return None
+        row = _CONN.execute("SELECT dav_url FROM person WHERE id=?", (pid,)).fetchone()
+    if row:
+        return ("url", row[0])
+    return None
 
-def _db():
-    return sqlite3.connect(DB_PATH)
+def _alias_person_id(conn, key: str) -> Optional[int]:
+    # person_alias 主键索引，由 sync_webdav 维护；旧库还没有这张表时退回 json_each 扫描
+    try:
+        row = conn.execute("""
+            SELECT p.id FROM person_alias a
+            JOIN person p ON p.id = a.person_id
+            WHERE a.alias=? AND p.enabled=1
+        """, (key,)).fetchone()
+    except sqlite3.OperationalError:
+        row = conn.execute("""
+            SELECT id FROM person
+            WHERE enabled=1 AND EXISTS (
+                SELECT 1
+                FROM json_each(alias_json)
+                WHERE json_each.value = ?
+            )
+        """, (key,)).fetchone()
+    return row[0] if row else None
 
 def find_person(conn, key: str):
     # 1) 主名精确
     row = conn.execute("SELECT id, name FROM person WHERE name=? AND enabled=1", (key,)).fetchone()
     if row:
         return row
-    # 2) 别名匹配（JSON里存数组，如 ["miho","天音"]）
-    row = conn.execute("""
-        SELECT id, name FROM person
-        WHERE enabled=1 AND EXISTS (
-            SELECT 1
-            FROM json_each(alias_json)
-            WHERE json_each.value = ?
-        )
-    """, (key,)).fetchone()
-    return row
+    # 2) 别名匹配（alias_json 里存数组，如 ["miho","天音"]）
+    pid = _alias_person_id(conn, key)
+    if pid is None:
+        return None
+    return conn.execute("SELECT id, name FROM person WHERE id=?", (pid,)).fetchone()
 
 def rand_image_rowid(conn, person_id: int):
-    # 方案 A：OFFSET 抽签（简洁）
-    stat = conn.execute("SELECT img_count FROM person_stats WHERE person_id=?", (person_id,)).fetchone()
-    if not stat or stat[0] <= 0:
+    stat = conn.execute(
+        "SELECT img_count, min_id, max_id FROM person_stats WHERE person_id=?", (person_id,)
+    ).fetchone()
+    if not stat or not stat[0] or stat[0] <= 0:
         return None
-    n = stat[0]
+    n, min_id, max_id = stat
+
+    if not RAND_STRICT_UNIFORM and min_id is not None and max_id is not None:
+        # 方案 B：在 [min_id, max_id] 随机取点，只接受正好落在本人有效 id 上的点（拒绝采样，均匀）；
+        # 区间里混有其他人员和已下线的行，落空就重抽，用完次数再走方案 A
+        for _ in range(RAND_PROBE_TRIES):
+            target = random.randint(min_id, max_id)
+            row = conn.execute("""
+                SELECT id, url FROM image
+                WHERE person_id=? AND active=1 AND id=?
+            """, (person_id, target)).fetchone()
+            if row is not None:
+                return row
+
+    # 方案 A：OFFSET 抽签（严格均匀，但要走 k 行索引）
     k = random.randrange(n)
-    row = conn.execute("""
+    return conn.execute("""
         SELECT id, url FROM image
         WHERE person_id=? AND active=1
         ORDER BY id LIMIT 1 OFFSET ?
     """, (person_id, k)).fetchone()
-    return row
 
-async def fetch_random_image_via_db(name: str) -> str | None:
-    conn = _db()
-    try:
-        p = find_person(conn, name)
+def resolve_local(url: str) -> Optional[Path]:
+    """WebDAV URL → 机器人主机上的挂载路径；主机不在 LOCAL_MOUNTS 中返回 None。"""
+    p = _parse(url)
+    root = LOCAL_MOUNTS.get(p.hostname or "")
+    if root is None:
+        return None
+    return root / unquote(p.path).lstrip("/")
+
+async def fetch_random_image_via_db(name: str) -> Optional[Tuple[str, str | Path]]:
+    """
+    随机取一张图。
+    返回 ('local', 本地路径) 或 ('url', 图片URL)，没有可用图片返回 None。
+    """
+    with _CONN_LOCK:
+        p = find_person(_CONN, name)
         if not p:
             return None
         pid, pname = p
-        row = rand_image_rowid(conn, pid)
-        if not row:
-            return None
-        _, url = row
-        # 复用你已有的 base64 下载→发图逻辑
-        return url
-    finally:
-        conn.close()
+        row = rand_image_rowid(_CONN, pid)
+    if not row:
+        return None
+    _, url = row
+    local_path = resolve_local(url)
+    if local_path is not None:
+        return ("local", local_path)
+    return ("url", url)
+
+async def random_image_seg(name: str) -> Optional[MessageSegment]:
+    """随机取一张图并组装成消息段；没有可用图片返回 None，下载失败抛异常。"""
+    hit = await fetch_random_image_via_db(name)
+    if hit is None:
+        return None
+    kind, value = hit
+    # loguru 会在级别不够时跳过格式化，INFO 下几乎零开销
+    logger.debug("picmap: matched {!r} -> ({}, {})", name, kind, value)
+    if kind == "local":
+        # 挂载在本机的文件直接交给 OneBot 端读取，不走 HTTP + base64
+        return MessageSegment.image(value.as_uri())
+    # url：主机未挂载到本地时才下载转 base64
+    return MessageSegment.image(await url_to_base64_file_spec(value, auth=DAV_AUTH))
+
+# ========== 触发方式 1：/pic 名字 =========
+pic_cmd = on_command("pic", priority=5, block=True)
+
+@pic_cmd.handle()
+async def _(args: Message = CommandArg()):
+    name = normalize(args.extract_plain_text())
+    if not name:
+        await pic_cmd.finish("用法：/pic 名字")
+    if lookup_db(name) is None:
+        await pic_cmd.finish(f"未收录：{name}")
+
+    try:
+        seg = await random_image_seg(name)
+    except Exception as e:
+        logger.exception(f"fetch image failed: {e}")
+        await pic_cmd.finish("图片获取失败，请稍后再试～")
+
+    if seg is None:
+        await pic_cmd.finish(f"没有可用图片：{name}")
+    await pic_cmd.finish(Message(seg))
 
 # ========== 触发方式 2：直接发“名字”（精确匹配）=========
 # 如果你希望只有被@时才触发，把 rule=to_me() 打开
@@ -162,37 +420,16 @@ async def _(event: MessageEvent):
     if not text:
         return
 
-    res = lookup_db(text)
-    if res is None:
+    if lookup_db(text) is None:
         return
 
-    kind, value = res
-    print(f"picmap: matched '{text}' -> ({kind}, {value})")
-
     try:
-        if kind == "url":
-            url = await fetch_random_image_via_db(text)
-            path = unquote(urlparse(url).path)
-            local_root = Path("/mnt")
-            local_path = local_root / path.lstrip("/")
-            print(local_path)
-            uri = local_path.as_uri()
-            print(uri)
-
-
-            # print(f"picmap: fetched url '{url}'")
-            # if not url:
-            #     await name_hit.finish(f"没有可用图片或未收录：{text}")
-            # file_spec = await url_to_base64_file_spec(
-            #     url,
-            #     auth=("fnos", "Ee_271828")
-            # )
-            seg = MessageSegment.image(uri)
-        else:  # local
-            seg = MessageSegment.image(f"file://{Path(value).as_posix()}")
+        seg = await random_image_seg(text)
     except Exception as e:
         logger.exception(f"fetch image failed: {e}")
         await name_hit.send("图片获取失败，请稍后再试～")
         return
 
+    if seg is None:
+        await name_hit.finish(f"没有可用图片或未收录：{text}")
     await name_hit.finish(Message(seg))
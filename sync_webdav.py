@@ -1,9 +1,10 @@
 # tools/sync_webdav.py
 from __future__ import annotations
-import os, time, sqlite3, xml.etree.ElementTree as ET
+import os, json, time, asyncio, functools, sqlite3, xml.etree.ElementTree as ET
+from io import BytesIO
 from urllib.parse import urlparse, urlunparse, urljoin, quote
 import httpx
-from typing import List
+from typing import List, Optional, Tuple
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -18,7 +19,17 @@ PERSONS_SEED = [
 ]
 
 # ========= 公用工具 =========
-IMAGE_EXTS = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
+IMAGE_EXTS = frozenset({".jpg", ".jpeg", ".png", ".gif", ".webp"})
+
+# PROPFIND 请求体/头每次都一样，模块加载时编码一次
+_PROPFIND_BODY = (
+    b'<?xml version="1.0" encoding="utf-8"?>\n'
+    b'<D:propfind xmlns:D="DAV:"><D:prop>'
+    b'<D:displayname/><D:getcontenttype/><D:resourcetype/>'
+    b'<D:getetag/><D:getlastmodified/>'
+    b'</D:prop></D:propfind>'
+)
+_PROPFIND_HEADERS = {"Depth":"1","Content-Type":"application/xml; charset=utf-8"}
 
 load_dotenv(Path(__file__).with_name(".env"))
 
@@ -35,68 +46,103 @@ CONFIG = {
     "TIMEOUT": _getint("PICMAP_TIMEOUT", 20),
 }
 
+@functools.lru_cache(maxsize=2048)
+def _parse(u: str):
+    # urlparse 是纯 Python 实现；同一 URL 在列目录/判断扩展名/入库时会被反复解析
+    return urlparse(u)
+
+@functools.lru_cache(maxsize=2048)
 def _enc(url: str) -> str:
-    p = urlparse(url)
+    p = _parse(url)
     return urlunparse((p.scheme, p.netloc, quote(p.path, safe="/%:@"), p.params, p.query, p.fragment))
 
 def _abs(base: str, href: str) -> str:
     if href.startswith("http://") or href.startswith("https://"):
         return href
-    bp = urlparse(base)
+    bp = _parse(base)
     if href.startswith("/"):
         return f"{bp.scheme}://{bp.netloc}{href}"
     return urljoin(base if base.endswith("/") else base + "/", href)
 
 def _is_image(u: str) -> bool:
-    path = urlparse(u).path.lower()
-    return any(path.endswith(ext) for ext in IMAGE_EXTS)
+    ext = _parse(u).path.rsplit(".", 1)
+    return len(ext) == 2 and ("." + ext[1].lower()) in IMAGE_EXTS
 
-def get_client() -> httpx.Client:
+def get_client() -> httpx.AsyncClient:
+    # 整个同步过程只建一个 client，所有人员共用同一个连接池
     auth = (CONFIG["DAV_USER"], CONFIG["DAV_PASS"]) if (CONFIG["DAV_USER"] or CONFIG["DAV_PASS"]) else None
-    return httpx.Client(timeout=CONFIG["TIMEOUT"], follow_redirects=True, auth=auth)
+    return httpx.AsyncClient(timeout=CONFIG["TIMEOUT"], follow_redirects=True, auth=auth,
+                             limits=httpx.Limits(max_keepalive_connections=8, max_connections=16))
 
 # ========= WebDAV 列目录 =========
-def list_dir(dir_or_file_url: str) -> List[str]:
+DirListing = Tuple[Optional[List[str]], Optional[str], Optional[str]]  # (urls, etag, last_modified)
+
+async def list_dir(c: httpx.AsyncClient, dir_or_file_url: str,
+                   etag: Optional[str] = None, mtime: Optional[str] = None) -> DirListing:
+    """
+    列出目录下的图片，同时返回目录自身的 getetag / getlastmodified。
+    传入上次记录的 etag/mtime 时，目录未变化（304 或值相同）返回的 urls 为 None。
+    """
     u = dir_or_file_url.strip()
     if not u:
-        return []
+        return [], None, None
     # 单文件：校验后返回
     if _is_image(u):
-        with get_client() as c:
-            r = c.head(_enc(u))
-            if r.status_code == 405:
-                r = c.get(_enc(u), headers={"Range":"bytes=0-0"})
-            r.raise_for_status()
-        return [u]
+        r = await c.head(_enc(u))
+        if r.status_code == 405:
+            r = await c.get(_enc(u), headers={"Range":"bytes=0-0"})
+        r.raise_for_status()
+        return [u], None, None
 
     # 目录：PROPFIND Depth:1
-    body = """<?xml version="1.0" encoding="utf-8"?>
-<D:propfind xmlns:D="DAV:">
-  <D:prop>
-    <D:displayname/><D:getcontenttype/><D:resourcetype/>
-  </D:prop>
-</D:propfind>"""
-    with get_client() as c:
-        r = c.request("PROPFIND", _enc(u), content=body.encode("utf-8"),
-                      headers={"Depth":"1","Content-Type":"application/xml; charset=utf-8"})
-        r.raise_for_status()
-        root = ET.fromstring(r.text)
+    headers = _PROPFIND_HEADERS
+    if etag:
+        headers = {**_PROPFIND_HEADERS, "If-None-Match": etag}
+    r = await c.request("PROPFIND", _enc(u), content=_PROPFIND_BODY, headers=headers)
+    # RFC 7232 §3.2：If-None-Match 命中时，GET/HEAD 以外的方法（含 PROPFIND）应返回 412，
+    # 部分服务器仍回 304，两者都视为“目录未变化”
+    if etag and r.status_code in (304, 412):
+        return None, etag, mtime
+    r.raise_for_status()
 
-    ns = {"D":"DAV:"}
+    # 直接对原始字节增量解析，每个 D:response 处理完即释放
+    base_enc = _enc(u).rstrip("/")
     out: List[str] = []
-    for resp in root.findall("D:response", ns):
-        href = resp.findtext("D:href", default="", namespaces=ns)
+    dir_etag = dir_mtime = None
+    for _, elem in ET.iterparse(BytesIO(r.content), events=("end",)):
+        if elem.tag != "{DAV:}response":
+            continue
+        href = elem.findtext("{DAV:}href", default="")
         if not href:
+            elem.clear()
             continue
         absu = _abs(u, href)
-        # 跳过目录本身
-        if _enc(absu).rstrip("/") == _enc(u).rstrip("/"):
+        # 目录本身：只取 etag / mtime
+        if _enc(absu).rstrip("/") == base_enc:
+            dir_etag = elem.findtext(".//{DAV:}getetag") or None
+            dir_mtime = elem.findtext(".//{DAV:}getlastmodified") or None
+            elem.clear()
             continue
+        elem.clear()
         if _is_image(absu):
             out.append(absu)
-    return out
+
+    # 服务器忽略 If-None-Match 时，用比对结果兜底
+    if (dir_etag and dir_etag == etag) or (not dir_etag and dir_mtime and dir_mtime == mtime):
+        return None, dir_etag, dir_mtime
+    return out, dir_etag, dir_mtime
 
 # ========= DB 基础 =========
+def _connect(path: str, **kwargs) -> sqlite3.Connection:
+    # WAL + synchronous=NORMAL：提交不再整文件 fsync，且不阻塞机器人侧的读
+    conn = sqlite3.connect(path, **kwargs)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-20000")
+    return conn
+
 def ensure_schema(cur: sqlite3.Cursor):
     cur.executescript("""
     CREATE TABLE IF NOT EXISTS person (
@@ -129,10 +175,35 @@ def ensure_schema(cur: sqlite3.Cursor):
       updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
       FOREIGN KEY (person_id) REFERENCES person(id) ON DELETE CASCADE
     );
+    CREATE TABLE IF NOT EXISTS person_alias (
+      alias TEXT PRIMARY KEY,
+      person_id INTEGER NOT NULL,
+      FOREIGN KEY (person_id) REFERENCES person(id) ON DELETE CASCADE
+    );
+    """)
+    # 旧库补列：目录的 ETag / Last-Modified，用于跳过未变化的目录
+    cols = {r[1] for r in cur.execute("PRAGMA table_info(person_stats)").fetchall()}
+    for col in ("dav_etag", "dav_mtime"):
+        if col not in cols:
+            cur.execute(f"ALTER TABLE person_stats ADD COLUMN {col} TEXT")
+
+def rebuild_aliases(conn: sqlite3.Connection):
+    # 把 person.alias_json 展开到 person_alias，机器人侧别名查找只需一次主键探测；
+    # 手工直接改 person 表的情况也会在下次同步时覆盖到。
+    # 只收已启用的人员：alias 是主键，禁用人员不能抢占与启用人员重名的别名
+    conn.executescript("""
+    BEGIN;
+    DELETE FROM person_alias;
+    INSERT OR IGNORE INTO person_alias (alias, person_id)
+    SELECT json_each.value, person.id
+    FROM person, json_each(person.alias_json)
+    WHERE person.enabled = 1 AND json_each.type = 'text';
+    COMMIT;
     """)
 
 def seed_persons(conn: sqlite3.Connection):
     if not PERSONS_SEED:
+        rebuild_aliases(conn)
         return
     cur = conn.cursor()
     for name, url, aliases in PERSONS_SEED:
@@ -140,56 +211,94 @@ def seed_persons(conn: sqlite3.Connection):
         INSERT INTO person(name, alias_json, dav_url, enabled)
         VALUES (?, json(?), ?, 1)
         ON CONFLICT(name) DO UPDATE SET alias_json=excluded.alias_json, dav_url=excluded.dav_url, enabled=1
-        """, (name, __import__("json").dumps(aliases or []), url))
+        """, (name, json.dumps(aliases or []), url))
     conn.commit()
+    rebuild_aliases(conn)
 
-def upsert_images(conn: sqlite3.Connection, person_id: int, urls: List[str]):
+def upsert_images(conn: sqlite3.Connection, person_id: int, urls: List[str],
+                  dav_etag: Optional[str] = None, dav_mtime: Optional[str] = None):
+    rows = [(u, os.path.splitext(_parse(u).path)[1].lower()) for u in urls]
     cur = conn.cursor()
-    cur.execute("UPDATE image SET active=0 WHERE person_id=?", (person_id,))
-    for u in urls:
-        ext = os.path.splitext(urlparse(u).path)[1].lower()
+    # 本次列表先进临时表，新增/保留/下线都在引擎内按主键做集合差，单个事务完成
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS _incoming (url TEXT PRIMARY KEY, ext TEXT)")
+        cur.execute("DELETE FROM _incoming")
+        cur.executemany("INSERT OR IGNORE INTO _incoming (url, ext) VALUES (?, ?)", rows)
         cur.execute("""
         INSERT INTO image (person_id, url, ext, active)
-        VALUES (?, ?, ?, 1)
+        SELECT ?, url, ext, 1 FROM _incoming WHERE true
         ON CONFLICT(person_id, url) DO UPDATE SET active=1, ext=excluded.ext
-        """, (person_id, u, ext))
-
-    cur.execute("""
-    INSERT INTO person_stats (person_id, img_count, min_id, max_id)
-    SELECT ?, COUNT(*), MIN(id), MAX(id)
-    FROM image WHERE person_id=? AND active=1
-    ON CONFLICT(person_id) DO UPDATE SET
-      img_count=excluded.img_count,
-      min_id=excluded.min_id,
-      max_id=excluded.max_id,
-      updated_at=CURRENT_TIMESTAMP
-    """, (person_id, person_id))
+        """, (person_id,))
+        cur.execute("""
+        UPDATE image SET active=0
+        WHERE person_id=? AND active=1 AND url NOT IN (SELECT url FROM _incoming)
+        """, (person_id,))
+
+        cur.execute("""
+        INSERT INTO person_stats (person_id, img_count, min_id, max_id, dav_etag, dav_mtime)
+        SELECT ?, COUNT(*), MIN(id), MAX(id), ?, ?
+        FROM image WHERE person_id=? AND active=1
+        ON CONFLICT(person_id) DO UPDATE SET
+          img_count=excluded.img_count,
+          min_id=excluded.min_id,
+          max_id=excluded.max_id,
+          dav_etag=excluded.dav_etag,
+          dav_mtime=excluded.dav_mtime,
+          updated_at=CURRENT_TIMESTAMP
+        """, (person_id, dav_etag, dav_mtime, person_id))
+    except Exception:
+        conn.rollback()
+        raise
     conn.commit()
 
-def sync_person(conn: sqlite3.Connection, name: str):
-    cur = conn.cursor()
-    row = cur.execute("SELECT id, dav_url, enabled FROM person WHERE name=?", (name,)).fetchone()
-    if not row:
-        raise RuntimeError(f"person not found: {name}")
-    pid, url, enabled = row
-    if not enabled:
-        return
-    urls = list_dir(url)
-    upsert_images(conn, pid, urls)
+# ========= 并发同步 =========
+# 只并发网络请求（PROPFIND，由信号量限流）；列完一个就在主线程写库，SQLite 始终单线程访问
+SYNC_CONCURRENCY = 8
 
-def sync_all():
+async def list_person(sem: asyncio.Semaphore, client: httpx.AsyncClient,
+                      pid: int, name: str, url: str,
+                      etag: Optional[str], mtime: Optional[str]):
+    async with sem:
+        try:
+            return pid, name, await list_dir(client, url, etag, mtime), None
+        except Exception as e:
+            return pid, name, None, e
+
+async def sync_all_async():
     db_path = CONFIG["DB_PATH"]
-    conn = sqlite3.connect(db_path)
+    conn = _connect(db_path)
     ensure_schema(conn.cursor())
     seed_persons(conn)
-    names = [r[0] for r in conn.execute("SELECT name FROM person WHERE enabled=1").fetchall()]
-    for name in names:
-        try:
-            sync_person(conn, name)
-            print(f"[OK] {name}")
-        except Exception as e:
-            print(f"[ERR] {name}: {e}")
-    conn.close()
+    rows = conn.execute("""
+    SELECT p.id, p.name, p.dav_url, s.dav_etag, s.dav_mtime
+    FROM person p LEFT JOIN person_stats s ON s.person_id = p.id
+    WHERE p.enabled=1
+    """).fetchall()
+
+    sem = asyncio.Semaphore(SYNC_CONCURRENCY)
+    try:
+        async with get_client() as client:
+            tasks = [list_person(sem, client, *row) for row in rows]
+            for fut in asyncio.as_completed(tasks):
+                pid, name, listing, err = await fut
+                if err is not None:
+                    print(f"[ERR] {name}: {err}")
+                    continue
+                urls, etag, mtime = listing
+                if urls is None:
+                    print(f"[SKIP] {name}: unchanged")
+                    continue
+                try:
+                    upsert_images(conn, pid, urls, etag, mtime)
+                    print(f"[OK] {name}")
+                except Exception as e:
+                    print(f"[ERR] {name}: {e}")
+    finally:
+        conn.close()
+
+def sync_all():
+    asyncio.run(sync_all_async())
 
 if __name__ == "__main__":
-    sync_all()
+    asyncio.run(sync_all_async())